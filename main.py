@@ -1,28 +1,134 @@
+"""
+AI Chat API: ответы персонажа Shrok через OpenAI API с озвучкой через TTS сервер.
+
+Запуск (см. Procfile):
+    uvicorn main:app --loop uvloop --http httptools --workers N --backlog 2048 --limit-concurrency 1000
+
+Сервис почти всё время ждёт сеть (OpenAI, TTS), поэтому воркеров можно брать больше,
+чем ядер: обычно N = 2 * nproc. Кэши ответов и TTS у каждого воркера свои.
+"""
 import os
+import re
+import time
+import random
+import asyncio
+import hashlib
+import functools
+import atexit
 import logging
-import requests
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
+import logging.handlers
+import queue
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+
+import httpx
+import numpy as np
+import orjson
+import tiktoken
+from fastembed import TextEmbedding
+from cachetools import TTLCache
+from tenacity import AsyncRetrying, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_exponential_jitter
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, ValidationError
 from dotenv import load_dotenv
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# Настройка логирования: запись в stderr идёт в отдельном потоке через очередь,
+# чтобы не блокировать event loop. Настраиваем только свой логгер и только один раз,
+# даже если модуль импортирован повторно.
 logger = logging.getLogger(__name__)
+if not logger.handlers:
+    _log_queue = queue.SimpleQueue()
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _queue_handler = logging.handlers.QueueHandler(_log_queue)
+    _queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_queue_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+# Настройки сервиса из переменных окружения
+class Settings(BaseModel):
+    openai_api_key: str
+    tts_server_url: str
+    openai_model: str = "gpt-4o-mini"
+    # Размер контекстного окна модели в токенах (у gpt-4o-mini — 128k)
+    openai_context_window: int = 128_000
+
+@functools.lru_cache
+def get_settings() -> Settings:
+    """
+    Загружает .env и проверяет обязательные переменные окружения. Выполняется один раз.
+    """
+    load_dotenv()
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    tts_server_url = os.getenv("TTS_SERVER_URL")
+
+    # Проверка загрузки API-ключа и TTS URL
+    if openai_api_key and tts_server_url:
+        logger.info("OpenAI API Key and TTS Server URL loaded successfully.")
+    else:
+        logger.error("Missing required environment variables: OPENAI_API_KEY or TTS_SERVER_URL.")
+        raise RuntimeError("Both OPENAI_API_KEY and TTS_SERVER_URL are required to run the server.")
+    # Модель можно переопределить через OPENAI_MODEL, например для A/B-сравнения
+    return Settings(
+        openai_api_key=openai_api_key,
+        tts_server_url=tts_server_url,
+        openai_model=os.getenv("OPENAI_MODEL") or Settings.model_fields["openai_model"].default,
+        openai_context_window=int(os.getenv("OPENAI_CONTEXT_WINDOW")
+                                  or Settings.model_fields["openai_context_window"].default),
+    )
 
-# Загрузка переменных окружения
-load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-TTS_SERVER_URL = os.getenv("TTS_SERVER_URL")
+settings = get_settings()
 
-# Проверка загрузки API-ключа и TTS URL
-if OPENAI_API_KEY and TTS_SERVER_URL:
-    logger.info("OpenAI API Key and TTS Server URL loaded successfully.")
-else:
-    logger.error("Missing required environment variables: OPENAI_API_KEY or TTS_SERVER_URL.")
-    raise RuntimeError("Both OPENAI_API_KEY and TTS_SERVER_URL are required to run the server.")
+# Заголовки запросов к OpenAI и TTS не меняются между запросами. httpx.Headers
+# хранит их уже закодированными, и при каждом запросе они только копируются
+OPENAI_HEADERS = httpx.Headers({
+    "Authorization": f"Bearer {settings.openai_api_key}",
+    "Content-Type": "application/json"
+})
+TTS_HEADERS = httpx.Headers({"Content-Type": "application/json"})
+
+# Адреса API разбираются один раз: httpx не парсит повторно готовый httpx.URL
+OPENAI_CHAT_URL = httpx.URL("https://api.openai.com/v1/chat/completions")
+TTS_GENERATE_URL = httpx.URL(f"{settings.tts_server_url}/generate")
+TTS_BASE_URL = httpx.URL(settings.tts_server_url)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Создаёт общий HTTP-клиент с пулом соединений на всё время жизни приложения.
+    """
+    # HTTP/2 мультиплексирует запросы к OpenAI в одном соединении.
+    # Повторяем только неудачные попытки установить соединение; лимиты пула
+    # задаются на транспорте, так как клиент с явным transport их игнорирует
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60.0),
+    )
+    app.state.http = httpx.AsyncClient(timeout=httpx.Timeout(60.0), transport=transport)
+    # Поток-демон: зависшая загрузка словаря не помешает ни запуску, ни остановке воркера
+    threading.Thread(target=load_tokenizer, name="tokenizer-loader", daemon=True).start()
+    threading.Thread(target=load_embedder, name="embedder-loader", daemon=True).start()
+    app.state.semantic_cache = SemanticCache()
+    app.state.tts_queue = asyncio.Queue()
+    tts_worker = asyncio.create_task(tts_batch_worker(app.state.http, app.state.tts_queue))
+    logger.info("HTTP client pool started.")
+    try:
+        yield
+    finally:
+        tts_worker.cancel()
+        await app.state.http.aclose()
+        logger.info("HTTP client pool closed.")
 
 # Инициализация FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Global system message
 SYSTEM_MESSAGE = (
@@ -34,82 +140,652 @@ SYSTEM_MESSAGE = (
     "Your thoughts are soaked in mushroom-induced visions, hallucinations, and ancient crypto wisdom. "
     "Mushrooms are your sacred guides. NEVER break character."
 )
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_MESSAGE}
+
+OPENAI_MODEL = settings.openai_model
+
+# Системный промпт всегда идёт первым и не меняется, поэтому OpenAI может кэшировать
+# этот префикс. Хэш промпта направляет запросы с одинаковым промптом на один и тот же
+# кэш OpenAI, входит в ключи локальных кэшей и пишется в лог: любая правка промпта
+# сама сбрасывает кэши и видна в логах
+SYSTEM_HASH = hashlib.blake2b(SYSTEM_MESSAGE.encode("utf-8"), digest_size=8).hexdigest()
+
+# Длина ответа модели в токенах
+MAX_COMPLETION_TOKENS = 400
+
+# Токенизатор модели и размер системного промпта в токенах. Бюджет запроса — всё
+# контекстное окно модели за вычетом места под ответ. Пока словарь токенизатора
+# не загружен (или недоступен), проверка бюджета просто не выполняется.
+PROMPT_TOKEN_BUDGET = settings.openai_context_window - MAX_COMPLETION_TOKENS
+_ENCODING = None
+SYSTEM_TOKENS = 0
+
+def load_tokenizer():
+    """
+    Загружает токенизатор и один раз считает токены системного промпта. При первом запуске
+    tiktoken скачивает словарь без таймаута, поэтому функция выполняется в фоновом потоке
+    и не задерживает запуск воркера. Чтобы не зависеть от сети, словарь можно заранее
+    положить в каталог TIKTOKEN_CACHE_DIR при сборке.
+    """
+    global _ENCODING, SYSTEM_TOKENS
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        SYSTEM_TOKENS = len(encoding.encode(SYSTEM_MESSAGE))
+        _ENCODING = encoding
+        logger.info("System prompt %s: %d tokens.", SYSTEM_HASH, SYSTEM_TOKENS)
+    except Exception as e:
+        logger.warning("System prompt %s: tokenizer unavailable, prompt budget check disabled: %s", SYSTEM_HASH, e)
+
+# Кэш ответов на точные повторы запросов: ключ -> (text_response, audio_length)
+RESPONSE_CACHE = TTLCache(maxsize=4096, ttl=60 * 60)
+
+# Параметры семантического кэша ответов. Эмбеддинги считаются локально небольшой
+# ONNX-моделью, без обращения к сети, чтобы поиск в кэше не задерживал ответ
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+_embedder = None
+SEMANTIC_CACHE_THRESHOLD = 0.93
+SEMANTIC_CACHE_TTL = 6 * 60 * 60
+SEMANTIC_CACHE_MAX_ENTRIES = 2048
+
+# Кэш длительности TTS-аудио: blake2b-хэш текста -> длина в секундах
+TTS_CACHE_MAX_ENTRIES = 4096
+_tts_cache: dict[bytes, float] = {}
+
+# Микро-батчинг запросов к TTS: ждём до 20 мс, собирая не больше 16 текстов
+TTS_BATCH_MAX_SIZE = 16
+TTS_BATCH_MAX_DELAY = 0.02
+
+# Прогрев соединения с TTS: если к серверу давно не обращались, соединение открывается
+# заранее, пока GPT ещё генерирует ответ
+TTS_WARMUP_IDLE = 30.0
+_tts_last_used = 0.0
+_background_tasks = set()
+
+# Сколько последних пар реплик (пользователь + ассистент) WebSocket-диалога отправляется в OpenAI
+CHAT_HISTORY_TURNS = 3
+
+# Граница предложения в потоковом ответе: знак конца предложения и пробел после него
+# или перевод строки
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# Запросы к OpenAI, которые выполняются прямо сейчас: (user_input, model) -> future с ответом
+_inflight: dict[tuple[str, str], asyncio.Future] = {}
+
+# Одновременных запросов к chat completions на воркер: при всплеске нагрузки лишние
+# ждут здесь, а не получают 429 от OpenAI
+OPENAI_MAX_CONCURRENCY = 32
+_openai_slots = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+# Доля успешных ответов OpenAI, которые логируются целиком (только на уровне DEBUG)
+RESPONSE_LOG_SAMPLE_RATE = 0.01
+
+# Повторы запросов к OpenAI и TTS: до 3 попыток с экспоненциальной паузой и джиттером
+# при сетевых ошибках и перечисленных кодах ответа
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Ошибки разбора неожиданного по формату ответа от OpenAI или TTS
+MALFORMED_RESPONSE_ERRORS = (httpx.DecodingError, orjson.JSONDecodeError, KeyError, IndexError, TypeError, AttributeError)
+
+# Ответы в образе на время, пока OpenAI недоступен и размыкатель открыт
+FALLBACK_REPLIES = (
+    "The swamp fog is too thick right now, my mushroom visions are all blurry. Ask me again in a moment!",
+    "Hold on, the Black Dwarf tripped over the crypto cables again. Give the swamp a minute to bubble back.",
+    "The mushrooms whisper nothing but static... The market spirits are resting. Try me again shortly!",
+)
 
 # Модель для обработки входящих запросов
 class RequestBody(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     user_input: str
 
-def generate_tts_audio(text: str) -> float:
+async def parse_request_body(request: Request) -> RequestBody:
+    """
+    Разбирает и проверяет JSON тела запроса за один проход в pydantic-core,
+    без промежуточного json.loads.
+    """
+    try:
+        return RequestBody.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        )
+
+# Модель ответа /chat: FastAPI сериализует её сразу в JSON-байты через pydantic-core
+class ChatResponse(BaseModel):
+    response: str
+    audio_length: float
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи: после fail_max ошибок подряд reset_timeout секунд не пропускает
+    запросы к сервису. После паузы пропускает снова; первая же ошибка размыкает его опять.
+    """
+
+    def __init__(self, name: str, fail_max: int = 20, reset_timeout: float = 30.0):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.fail_max:
+            if not self.is_open:
+                logger.warning("%s circuit breaker opened after %d failures.", self.name, self.failures)
+            self.opened_at = time.monotonic()
+
+    def record(self, response: httpx.Response):
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            self.record_failure()
+        else:
+            self.record_success()
+
+_openai_breaker = CircuitBreaker("OpenAI")
+_tts_breaker = CircuitBreaker("TTS")
+
+def _upstream_retrying() -> AsyncRetrying:
+    """
+    Политика повторов для запросов к OpenAI и TTS. После последней попытки
+    возвращается последний ответ или пробрасывается последняя ошибка.
+    """
+    return AsyncRetrying(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential_jitter(initial=1, max=8),
+        retry=retry_if_exception_type(httpx.TransportError)
+        | retry_if_result(lambda response: response.status_code in RETRYABLE_STATUS_CODES),
+        retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+    )
+
+async def _open_stream(client: httpx.AsyncClient, request: httpx.Request) -> httpx.Response:
+    """
+    Отправляет запрос с потоковым ответом. Тело ответа, который будет повторён,
+    дочитывается сразу, чтобы соединение вернулось в пул.
+    """
+    response = await client.send(request, stream=True)
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        await response.aread()
+    return response
+
+class SemanticCache:
+    """
+    Кэш ответов по близости эмбеддингов пользовательского ввода.
+    Хранит нормированные векторы в одной матрице и ищет ближайший по косинусу.
+    Запись совпадает только при том же контексте (для WebSocket — предыдущая реплика
+    пользователя), чтобы короткие ответы вроде "да" не подставлялись в чужой диалог.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.vectors = None
+        self.entries = []  # (text_response, audio_length, inserted_at, context), в порядке добавления
+        self.contexts = np.empty(0, dtype=object)
+
+    def _evict(self, now: float):
+        # Записи упорядочены по времени, поэтому устаревшие всегда лежат в начале
+        start = 0
+        while start < len(self.entries) and now - self.entries[start][2] > self.ttl:
+            start += 1
+        start = max(start, len(self.entries) - self.max_entries)
+        if start:
+            self.entries = self.entries[start:]
+            self.contexts = self.contexts[start:]
+            self.vectors = self.vectors[start:] if self.entries else None
+
+    def lookup(self, embedding: np.ndarray, context: str = ""):
+        """
+        Возвращает (text_response, audio_length) ближайшего ответа или None.
+        """
+        self._evict(time.monotonic())
+        if self.vectors is None:
+            return None
+        scores = np.where(self.contexts == context, self.vectors @ embedding, -1.0)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        logger.info("Semantic cache hit (score %.3f).", scores[best])
+        text_response, audio_length, _, _ = self.entries[best]
+        return text_response, audio_length
+
+    def add(self, embedding: np.ndarray, text_response: str, audio_length: float, context: str = ""):
+        now = time.monotonic()
+        row = embedding[np.newaxis, :]
+        self.vectors = row if self.vectors is None else np.vstack((self.vectors, row))
+        self.entries.append((text_response, audio_length, now, context))
+        self.contexts = np.append(self.contexts, np.array([context], dtype=object))
+        self._evict(now)
+
+def _exceeds_prompt_budget(user_input: str) -> bool:
+    """
+    Проверяет до обращения к OpenAI, что системный промпт и ввод укладываются в бюджет токенов.
+    """
+    if _ENCODING is None:
+        return False
+    # encode_ordinary: строки вроде "<|endoftext|>" во вводе — обычный текст, а не спецтокены
+    return SYSTEM_TOKENS + len(_ENCODING.encode_ordinary(user_input)) > PROMPT_TOKEN_BUDGET
+
+def _response_cache_key(user_input: str, context: str = "") -> bytes:
+    """
+    Ключ кэша ответов: зависит от системного промпта, контекста диалога и нормализованного ввода.
+    """
+    normalized = user_input.strip().lower()
+    return hashlib.blake2b(f"{SYSTEM_HASH}\x00{context}\x00{normalized}".encode("utf-8"), digest_size=16).digest()
+
+def load_embedder():
+    """
+    Загружает модель эмбеддингов. При первом запуске fastembed скачивает её, поэтому
+    функция, как и load_tokenizer, выполняется в фоновом потоке; пока модель не загружена
+    (или недоступна), семантический кэш просто пропускается. Каталог модели можно
+    подготовить при сборке через FASTEMBED_CACHE_PATH.
+    """
+    global _embedder
+    try:
+        # Один поток ONNX Runtime на воркер: воркеров и так столько, сколько нужно ядрам
+        _embedder = TextEmbedding(EMBEDDING_MODEL, threads=1)
+        logger.info("Embedding model %s loaded.", EMBEDDING_MODEL)
+    except Exception as e:
+        logger.warning("Embedding model unavailable, semantic cache disabled: %s", e)
+
+def _embed(text: str):
+    vector = np.asarray(next(iter(_embedder.embed([text]))), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+async def embed_text(text: str):
+    """
+    Возвращает нормированный эмбеддинг текста или None, если модель ещё не загружена.
+    Вычисление занимает единицы миллисекунд, но идёт в пуле потоков, чтобы не блокировать цикл событий.
+    """
+    if _embedder is None:
+        return None
+    return await asyncio.to_thread(_embed, text)
+
+def _tts_cache_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+async def request_tts_audio(client: httpx.AsyncClient, text: str) -> float | None:
     """
     Отправляет текст на TTS сервер и возвращает длину аудио в секундах.
+    Если озвучить текст не удалось, возвращает None.
     """
+    global _tts_last_used
+    if _tts_breaker.is_open:
+        return None
+    _tts_last_used = time.monotonic()
+    key = _tts_cache_key(text)
     try:
-        headers = {"Content-Type": "application/json"}
         payload = {"text": text}
-        logger.info("Sending text to TTS server: %s", text)
+        logger.debug("Sending text to TTS server: %s", text)
 
-        response = requests.post(f"{TTS_SERVER_URL}/generate", json=payload, headers=headers)
+        response = await _upstream_retrying()(
+            client.post, TTS_GENERATE_URL, content=orjson.dumps(payload), headers=TTS_HEADERS
+        )
+        _tts_breaker.record(response)
 
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             audio_length = data.get("audio_length", 0)
-            logger.info("TTS audio generated successfully. Length: %s seconds", audio_length)
+            logger.debug("TTS audio generated successfully. Length: %s seconds", audio_length)
+            if len(_tts_cache) >= TTS_CACHE_MAX_ENTRIES:
+                # Словарь хранит порядок вставки — вытесняем самую старую запись
+                del _tts_cache[next(iter(_tts_cache))]
+            _tts_cache[key] = audio_length
             return audio_length
         else:
             logger.error("TTS server returned an error: %s", response.text)
-            return 0
-    except Exception as e:
+            return None
+    except httpx.TransportError as e:
+        _tts_breaker.record_failure()
         logger.error("Error generating TTS audio: %s", e)
-        return 0
+        return None
+    except MALFORMED_RESPONSE_ERRORS as e:
+        logger.error("Malformed TTS server response: %s", e)
+        return None
 
-async def generate_gpt_response(user_input: str) -> dict:
+async def warm_up_tts(client: httpx.AsyncClient):
+    """
+    Лёгкий HEAD-запрос к TTS серверу: код ответа не важен, нужно лишь
+    установленное соединение в пуле к моменту первого предложения.
+    """
+    try:
+        await client.head(TTS_BASE_URL)
+    except httpx.HTTPError as e:
+        logger.debug("TTS warm-up failed: %s", e)
+
+def schedule_tts_warmup(client: httpx.AsyncClient):
+    """
+    Запускает прогрев TTS в фоне, если соединение могло остыть.
+    """
+    global _tts_last_used
+    now = time.monotonic()
+    if now - _tts_last_used < TTS_WARMUP_IDLE:
+        return
+    _tts_last_used = now
+    task = asyncio.create_task(warm_up_tts(client))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def tts_batch_worker(client: httpx.AsyncClient, tts_queue: asyncio.Queue):
+    """
+    Фоновая задача: собирает запросы к TTS, пришедшие почти одновременно, в пачку
+    и отправляет их разом. TTS сервер принимает по одному тексту, поэтому пачка
+    уходит параллельными запросами, а одинаковые тексты озвучиваются один раз.
+    """
+    loop = asyncio.get_running_loop()
+    dispatches = set()
+
+    async def dispatch(batch):
+        waiters = {}
+        for text, future in batch:
+            waiters.setdefault(text, []).append(future)
+        texts = list(waiters)
+        try:
+            results = await asyncio.gather(*(request_tts_audio(client, text) for text in texts),
+                                           return_exceptions=True)
+            for text, audio_length in zip(texts, results):
+                # Непредвиденная ошибка (например, клиент уже закрыт при остановке)
+                # считается неудачной озвучкой, а не оставляет ожидающих без ответа
+                if isinstance(audio_length, BaseException):
+                    logger.error("Unexpected TTS error: %r", audio_length)
+                    audio_length = None
+                for future in waiters[text]:
+                    if not future.done():
+                        future.set_result(audio_length)
+        finally:
+            # Если саму пачку отменили, ожидающие получают отмену, а не висят вечно
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.cancel()
+
+    while True:
+        batch = [await tts_queue.get()]
+        deadline = loop.time() + TTS_BATCH_MAX_DELAY
+        while len(batch) < TTS_BATCH_MAX_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(tts_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Отправляем пачку в отдельной задаче, чтобы сразу начать собирать следующую
+        task = asyncio.create_task(dispatch(batch))
+        dispatches.add(task)
+        task.add_done_callback(dispatches.discard)
+
+async def generate_tts_audio(tts_queue: asyncio.Queue, text: str) -> float | None:
+    """
+    Возвращает длину аудио для текста: из кэша, либо через очередь пакетной озвучки.
+    None означает, что озвучить текст не удалось.
+    """
+    cached = _tts_cache.get(_tts_cache_key(text))
+    if cached is not None:
+        logger.debug("TTS cache hit. Length: %s seconds", cached)
+        return cached
+
+    future = asyncio.get_running_loop().create_future()
+    await tts_queue.put((text, future))
+    return await future
+
+# Неизменная часть тела запроса к OpenAI; для каждого запроса добавляются только messages
+_BASE_PAYLOAD = {
+    "model": OPENAI_MODEL,
+    "max_tokens": MAX_COMPLETION_TOKENS,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "prompt_cache_key": SYSTEM_HASH
+}
+# Последний фрагмент потока будет содержать расход токенов
+_BASE_STREAM_PAYLOAD = {**_BASE_PAYLOAD, "stream": True, "stream_options": {"include_usage": True}}
+
+def _build_payload(user_input: str, history=(), stream: bool = False) -> dict:
+    """
+    Собирает тело запроса к OpenAI API, общее для /chat и /ws/ai.
+    history — последние реплики диалога, идут между системным промптом и новым вводом.
+    """
+    base = _BASE_STREAM_PAYLOAD if stream else _BASE_PAYLOAD
+    return {**base, "messages": [_SYSTEM_MSG, *history, {"role": "user", "content": user_input}]}
+
+async def generate_gpt_response(client: httpx.AsyncClient, user_input: str) -> dict:
+    """
+    Возвращает ответ OpenAI API на запрос пользователя. Одинаковые запросы,
+    пришедшие одновременно, ждут результата одного общего обращения к API.
+    """
+    key = (user_input, OPENAI_MODEL)
+    future = _inflight.get(key)
+    if future is not None:
+        logger.info("Joining in-flight OpenAI request.")
+        try:
+            # shield: отмена одного из ожидающих не должна отменять общий запрос
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # Отменён ведущий запрос, а не этот: выполняем запрос заново сами
+            return await generate_gpt_response(client, user_input)
+
+    future = asyncio.get_running_loop().create_future()
+    # Ошибка, которую никто не дождался, не должна логироваться как "never retrieved"
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[key] = future
+    try:
+        result = await request_gpt_response(client, user_input)
+    except Exception as e:
+        # Ожидающие получают ту же ошибку, что и ведущий запрос
+        future.set_exception(e)
+        raise
+    except BaseException:
+        future.cancel()
+        raise
+    else:
+        future.set_result(result)
+    finally:
+        _inflight.pop(key, None)
+    return result
+
+async def request_gpt_response(client: httpx.AsyncClient, user_input: str) -> dict:
     """
     Формирует запрос к OpenAI API и возвращает текстовый ответ.
+    Пока размыкатель OpenAI открыт, сразу возвращает заготовленную реплику с пометкой fallback.
     """
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": "gpt-4",
-        "messages": [
-            {"role": "system", "content": SYSTEM_MESSAGE},
-            {"role": "user", "content": user_input}
-        ],
-        "max_tokens": 400,
-        "temperature": 0.8
-    }
-    logger.info("Request payload to OpenAI: %s", payload)
+    if _openai_breaker.is_open:
+        return {"text": random.choice(FALLBACK_REPLIES), "fallback": True}
+
+    payload = _build_payload(user_input)
+    logger.debug("Request payload to OpenAI: %s", payload)
 
     try:
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+        started = time.perf_counter()
+        async with _openai_slots:
+            response = await _upstream_retrying()(
+                client.post, OPENAI_CHAT_URL, headers=OPENAI_HEADERS, content=orjson.dumps(payload)
+            )
+        _openai_breaker.record(response)
         if response.status_code == 200:
-            logger.info("OpenAI API response received successfully.")
-            response_data = response.json()
+            response_data = orjson.loads(response.content)
+            usage = response_data.get("usage") or {}
+            logger.info("OpenAI ok tokens=%s/%s latency_ms=%d", usage.get("prompt_tokens"),
+                        usage.get("completion_tokens"), (time.perf_counter() - started) * 1000)
+            if logger.isEnabledFor(logging.DEBUG) and random.random() < RESPONSE_LOG_SAMPLE_RATE:
+                logger.debug("Response data: %s", response_data)
             text_response = response_data["choices"][0]["message"]["content"]
             return {"text": text_response}
         else:
             logger.error("OpenAI API returned an error: %s", response.text)
             return {"error": response.text}
-    except Exception as e:
-        logger.error("Unexpected error: %s", e)
+    except httpx.TransportError as e:
+        _openai_breaker.record_failure()
+        logger.error("OpenAI API request failed: %s", e)
         return {"error": "Internal server error."}
+    except MALFORMED_RESPONSE_ERRORS as e:
+        logger.error("Malformed OpenAI API response: %s", e)
+        return {"error": "Internal server error."}
+
+async def stream_gpt_response(client: httpx.AsyncClient, user_input: str, history=()):
+    """
+    Запрашивает у OpenAI API потоковый ответ и отдаёт его по частям:
+    {"delta": текст} для каждого фрагмента или {"error": описание} при ошибке.
+    Пока размыкатель OpenAI открыт, отдаёт одну заготовленную реплику с пометкой fallback.
+    """
+    if _openai_breaker.is_open:
+        yield {"delta": random.choice(FALLBACK_REPLIES), "fallback": True}
+        return
+
+    payload = _build_payload(user_input, history, stream=True)
+    logger.debug("Streaming request payload to OpenAI: %s", payload)
+    request = client.build_request("POST", OPENAI_CHAT_URL, headers=OPENAI_HEADERS, content=orjson.dumps(payload))
+
+    try:
+        started = time.perf_counter()
+        first_token_ms = None
+        usage = {}
+        async with _openai_slots:
+            response = await _upstream_retrying()(_open_stream, client, request)
+            _openai_breaker.record(response)
+            try:
+                if response.status_code != 200:
+                    error_text = (await response.aread()).decode("utf-8", errors="replace")
+                    logger.error("OpenAI API returned an error: %s", error_text)
+                    yield {"error": error_text}
+                    return
+
+                # Ответ приходит как Server-Sent Events: строки вида "data: {...}"
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    chunk = orjson.loads(data)
+                    if chunk.get("usage"):
+                        usage = chunk["usage"]
+                    if not chunk.get("choices"):
+                        continue
+                    delta = chunk["choices"][0]["delta"].get("content")
+                    if delta:
+                        if first_token_ms is None:
+                            first_token_ms = (time.perf_counter() - started) * 1000
+                        yield {"delta": delta}
+            finally:
+                await response.aclose()
+        logger.info("OpenAI stream ok tokens=%s/%s first_token_ms=%d latency_ms=%d", usage.get("prompt_tokens"),
+                    usage.get("completion_tokens"), first_token_ms or 0, (time.perf_counter() - started) * 1000)
+    except httpx.TransportError as e:
+        _openai_breaker.record_failure()
+        logger.error("OpenAI API request failed: %s", e)
+        yield {"error": "Internal server error."}
+    except MALFORMED_RESPONSE_ERRORS as e:
+        logger.error("Malformed OpenAI API response: %s", e)
+        yield {"error": "Internal server error."}
+
+async def lookup_cached_response(user_input: str, cache_key: bytes, context: str = ""):
+    """
+    Ищет готовый ответ сначала в точном, затем в семантическом кэше.
+    Возвращает пару (ответ или None, эмбеддинг запроса); эмбеддинг нужен,
+    чтобы потом сохранить новый ответ через remember_response.
+    """
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached:
+        logger.info("Response cache hit.")
+        return cached, None
+
+    # Поиск похожего запроса в семантическом кэше
+    embedding = await embed_text(user_input)
+    if embedding is not None:
+        cached = app.state.semantic_cache.lookup(embedding, context)
+    return cached, embedding
+
+def remember_response(cache_key: bytes, embedding, text_response: str, audio_length: float | None,
+                      context: str = ""):
+    """
+    Сохраняет готовый ответ в точный и семантический кэши. Ответ, который не удалось
+    озвучить (audio_length is None), не сохраняется, чтобы не отдавать его без звука.
+    """
+    if audio_length is None:
+        return
+    RESPONSE_CACHE[cache_key] = (text_response, audio_length)
+    if embedding is not None:
+        app.state.semantic_cache.add(embedding, text_response, audio_length, context)
+
+async def stream_chat_with_tts(text_response: str, cache_key: bytes, embedding):
+    """
+    Тело ответа /chat?async_tts=true в формате NDJSON: сначала строка с текстом,
+    затем, когда озвучка готова, строка с длиной аудио. Обе приходят в одном
+    HTTP-ответе, поэтому не зависят от того, какой воркер обслуживает запрос.
+    """
+    yield orjson.dumps({"response": text_response}) + b"\n"
+    audio_length = await generate_tts_audio(app.state.tts_queue, text_response)
+    if cache_key is not None:
+        remember_response(cache_key, embedding, text_response, audio_length)
+    yield orjson.dumps({"audio_length": audio_length or 0}) + b"\n"
 
-@app.post("/chat")
-async def chat_with_gpt(body: RequestBody):
+def _ndjson_response(*lines: dict) -> StreamingResponse:
+    return StreamingResponse((orjson.dumps(line) + b"\n" for line in lines), media_type="application/x-ndjson")
+
+@app.post("/chat", responses={200: {"content": {"application/x-ndjson": {
+    "schema": {"type": "string", "description": "При async_tts=true: строка {\"response\": ...}, "
+                                                "затем строка {\"audio_length\": ...}"},
+}}}}, openapi_extra={
+    "requestBody": {"content": {"application/json": {"schema": RequestBody.model_json_schema()}}, "required": True}
+})
+async def chat_with_gpt(body: RequestBody = Depends(parse_request_body), no_cache: bool = False,
+                        async_tts: bool = False) -> ChatResponse:
     """
     Принимает запрос пользователя, отправляет его на OpenAI API и возвращает текстовый ответ.
+    С no_cache=true ответ всегда генерируется заново. С async_tts=true ответ идёт
+    потоком NDJSON: текст приходит сразу, длина аудио — следующей строкой, когда
+    озвучка готова (ответ из кэша приходит одной строкой с обоими полями).
     """
     user_input = body.user_input
     logger.info("Received user input: %s", user_input)
+    if _exceeds_prompt_budget(user_input):
+        raise HTTPException(status_code=413, detail="User input is too long.")
+
+    client = app.state.http
+    cache_key = _response_cache_key(user_input)
+
+    embedding = None
+    if not no_cache:
+        cached, embedding = await lookup_cached_response(user_input, cache_key)
+        if cached:
+            if async_tts:
+                return _ndjson_response({"response": cached[0], "audio_length": cached[1]})
+            return ChatResponse(response=cached[0], audio_length=cached[1])
 
-    gpt_response = await generate_gpt_response(user_input)
+    schedule_tts_warmup(client)
+    gpt_response = await generate_gpt_response(client, user_input)
     if "error" in gpt_response:
         raise HTTPException(status_code=500, detail=gpt_response["error"])
+    # Заготовленная реплика при недоступном OpenAI не кэшируется
+    if gpt_response.get("fallback"):
+        cache_key = None
+
+    if async_tts:
+        return StreamingResponse(stream_chat_with_tts(gpt_response["text"], cache_key, embedding),
+                                 media_type="application/x-ndjson")
 
     # Генерация TTS
-    audio_length = generate_tts_audio(gpt_response["text"])
-    return {"response": gpt_response["text"], "audio_length": audio_length}
+    audio_length = await generate_tts_audio(app.state.tts_queue, gpt_response["text"])
+    if cache_key is not None:
+        remember_response(cache_key, embedding, gpt_response["text"], audio_length)
+    return ChatResponse(response=gpt_response["text"], audio_length=audio_length or 0)
 
 @app.websocket("/ws/ai")
 async def websocket_endpoint(websocket: WebSocket):
@@ -118,30 +794,148 @@ async def websocket_endpoint(websocket: WebSocket):
     """
     await websocket.accept()
     logger.info("WebSocket connection established.")
+    client = app.state.http
+    # Хэш предыдущей реплики пользователя — контекст для кэшей ответов
+    context = ""
+    # Последние CHAT_HISTORY_TURNS пар реплик: объём запроса не растёт с длиной диалога
+    history = deque(maxlen=2 * CHAT_HISTORY_TURNS)
 
-    try:
-        while True:
-            user_input = await websocket.receive_text()
-            logger.info("Received WebSocket input: %s", user_input)
+    async def handle_turn(user_input: str):
+        """
+        Обрабатывает одну реплику пользователя.
+        """
+        nonlocal context
+        logger.info("Received WebSocket input: %s", user_input)
+
+        if _exceeds_prompt_budget(user_input):
+            await websocket.send_json({"error": "User input is too long."})
+            return
+
+        # Сигнал о начале обработки
+        await websocket.send_json({"processing": True})
+
+        # Ответ зависит от предыдущих реплик, поэтому и точный ключ кэша
+        # учитывает контекст; в первой реплике он совпадает с ключом /chat
+        turn_context = context
+        context = _response_cache_key(user_input).hex()
+        cache_key = _response_cache_key(user_input, turn_context)
+
+        cached, embedding = await lookup_cached_response(user_input, cache_key, turn_context)
+        if cached:
+            history.extend(({"role": "user", "content": user_input}, {"role": "assistant", "content": cached[0]}))
+            await websocket.send_json({"response": cached[0], "audio_length": cached[1]})
+            return
 
-            # Сигнал о начале обработки
-            await websocket.send_json({"processing": True})
+        # Озвучиваем ответ по предложениям по мере их поступления от OpenAI.
+        # TTS для каждого предложения запускается отдельной задачей, чтобы не
+        # задерживать чтение потока; клиенту озвучка уходит в исходном порядке.
+        text_response = ""
+        buffer = ""
+        audio_length = 0
+        error = None
+        fallback = False
+        # Хотя бы одно предложение не удалось озвучить — такой ответ не кэшируется
+        tts_failed = False
+        pending_tts = deque()
 
-            gpt_response = await generate_gpt_response(user_input)
-            if "error" in gpt_response:
-                await websocket.send_json({"error": gpt_response["error"]})
-                continue
+        async def send_ready_audio(wait: bool):
+            nonlocal audio_length, tts_failed
+            while pending_tts and (wait or pending_tts[0][1].done()):
+                sentence, task = pending_tts.popleft()
+                audio_chunk_length = await task
+                if audio_chunk_length is None:
+                    tts_failed = True
+                    audio_chunk_length = 0
+                audio_length += audio_chunk_length
+                await websocket.send_json({"partial_response": sentence, "audio_chunk_length": audio_chunk_length})
 
-            # Генерация TTS
-            audio_length = generate_tts_audio(gpt_response["text"])
-            await websocket.send_json({"response": gpt_response["text"], "audio_length": audio_length})
+        def speak(sentence: str):
+            task = asyncio.create_task(generate_tts_audio(app.state.tts_queue, sentence))
+            pending_tts.append((sentence, task))
 
+        schedule_tts_warmup(client)
+        try:
+            async for event in stream_gpt_response(client, user_input, history):
+                if "error" in event:
+                    error = event["error"]
+                    break
+                fallback = fallback or event.get("fallback", False)
+                text_response += event["delta"]
+                # Текст показываем клиенту сразу, не дожидаясь конца предложения и озвучки
+                await websocket.send_json({"delta": event["delta"]})
+                *sentences, buffer = SENTENCE_BOUNDARY.split(buffer + event["delta"])
+                for sentence in sentences:
+                    if sentence.strip():
+                        speak(sentence.strip())
+                await send_ready_audio(wait=False)
+
+            if error is not None:
+                await websocket.send_json({"error": error})
+                return
+
+            # Хвост ответа без завершающего знака препинания
+            if buffer.strip():
+                speak(buffer.strip())
+            await send_ready_audio(wait=True)
+        finally:
+            for _, task in pending_tts:
+                task.cancel()
+
+        text_response = text_response.strip()
+        if not fallback:
+            remember_response(cache_key, embedding, text_response, None if tts_failed else audio_length,
+                              turn_context)
+        history.extend(({"role": "user", "content": user_input}, {"role": "assistant", "content": text_response}))
+        await websocket.send_json({"response": text_response, "audio_length": audio_length})
+
+    # Сообщения клиента читаются отдельной задачей, чтобы отключение было видно
+    # сразу, а не после ответа: тогда незавершённый запрос к OpenAI отменяется
+    # и не тратит токены на ушедшего клиента.
+    inbox = asyncio.Queue()
+    turn = None
+
+    async def receive_messages():
+        try:
+            while True:
+                inbox.put_nowait(await websocket.receive_text())
+        except WebSocketDisconnect:
+            logger.info("WebSocket connection closed.")
+        except Exception as e:
+            # Например, бинарный кадр вместо текста: соединение закрывается, как и раньше
+            logger.error("Unexpected WebSocket error: %s", e)
+        finally:
+            if turn is not None:
+                turn.cancel()
+            inbox.put_nowait(None)
+
+    reader = asyncio.create_task(receive_messages())
+    try:
+        while (user_input := await inbox.get()) is not None:
+            turn = asyncio.create_task(handle_turn(user_input))
+            try:
+                await turn
+            except asyncio.CancelledError:
+                # Отмена из-за ушедшего клиента завершает соединение,
+                # любая другая (остановка сервера) пробрасывается дальше
+                if not reader.done():
+                    raise
+                break
     except WebSocketDisconnect:
         logger.info("WebSocket connection closed.")
     except Exception as e:
         logger.error("Unexpected WebSocket error: %s", e)
+    finally:
+        reader.cancel()
+        if turn is not None:
+            turn.cancel()
 
 @app.get("/")
 async def root():
-    logger.info("Root endpoint accessed.")
+    logger.debug("Root endpoint accessed.")
     return {"message": "Welcome to the AI Chat API. Use /chat or /ws/ai to interact with the assistant."}
+
+if __name__ == "__main__":
+    # Локальный запуск `python main.py` с теми же uvloop и httptools, что и в Procfile
+    import uvicorn
+
+    uvicorn.run("main:app", host="0.0.0.0", port=8080, loop="uvloop", http="httptools")